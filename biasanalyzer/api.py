@@ -11,16 +11,21 @@ from biasanalyzer.utils import get_direction_arrow
 class BIAS:
     _instance = None
 
-    def __init__(self):
+    def __init__(self, config_file_path=None):
+        # __init__ runs on every BIAS() call even though __new__ returns the singleton, so only
+        # initialize once to avoid resetting the configuration and the cached cohort action
+        if getattr(self, '_initialized', False):
+            return
+        self._initialized = True
         self.config = {}
         self.bias_db = None
         self.omop_cdm_db = None
         self.cohort_action = None
+        self.set_config(config_file_path)
 
     def __new__(cls, config_file_path=None):
         if cls._instance is None:
             cls._instance = super(BIAS, cls).__new__(cls)
-            cls._instance.set_config(config_file_path)
         return cls._instance
 
     def set_config(self, config_file_path: str):
@@ -169,6 +174,16 @@ class BIAS:
             print('failed to create a valid cohort action object')
             return None
 
+    def create_cohort_from_parquet(self, cohort_name, cohort_desc, parquet_path, created_by):
+        c_action = self._set_cohort_action()
+        if c_action:
+            created_cohort = c_action.create_cohort_from_parquet(cohort_name, cohort_desc, parquet_path, created_by)
+            print('cohort created successfully')
+            return created_cohort
+        else:
+            print('failed to create a valid cohort action object')
+            return None
+
     def compare_cohorts(self, cohort_id1, cohort_id2):
         c_action = self._set_cohort_action()
         if c_action:
@@ -177,6 +192,13 @@ class BIAS:
             print('failed to create a valid cohort action object')
 
     def cleanup(self):
-        self.bias_db.close()
-        self.omop_cdm_db.close()
-        del self.cohort_action
+        # databases are only set once set_root_omop has been called
+        if self.bias_db is not None:
+            self.bias_db.close()
+            self.bias_db = None
+        if self.omop_cdm_db is not None:
+            self.omop_cdm_db.close()
+            self.omop_cdm_db = None
+        self.cohort_action = None
+        # let the next BIAS() start from a clean instance instead of this closed one
+        BIAS._instance = None
@@ -1,11 +1,16 @@
+import logging
 from sqlalchemy.exc import SQLAlchemyError
 import duckdb
+import pandas as pd
 from datetime import datetime
-from biasanalyzer.models import CohortDefinition, Cohort
+from biasanalyzer.models import CohortDefinition
 from biasanalyzer.database import OMOPCDMDatabase, BiasDatabase
 from biasanalyzer.utils import hellinger_distance
 
 
+logger = logging.getLogger(__name__)
+
+
 class CohortData:
     def __init__(self, cohort_id: int, bias_db: BiasDatabase, omop_db: OMOPCDMDatabase):
         self.cohort_id = cohort_id
@@ -18,7 +23,7 @@ class CohortData:
     def data(self):
         """
         query the database to get the cohort data using cohort_id. Return cached data if already fetched
-        :return: cohort data
+        :return: cohort data as a pandas DataFrame
         """
         if self._cohort_data is None:
             self._cohort_data = self.bias_db.get_cohort(self.cohort_id)
@@ -34,16 +39,31 @@ class CohortData:
         """
         Get aggregation statistics for the cohort in BiasDatabase.
         variable is optional with a default empty string. Supported variables are: age, gender,
-        race, and ethnicity.
+        race, and ethnicity. BiasDatabase caches the stats until rows are added to the cohort
         """
         return self.bias_db.get_cohort_basic_stats(self.cohort_id, variable=variable)
 
+    def get_stats_bulk(self, variables=('age', 'gender', 'race', 'ethnicity')):
+        """
+        Get aggregation statistics of several variables for the cohort in BiasDatabase with a single
+        query. Return a dict keyed by variable
+        """
+        return self.bias_db.get_cohort_stats_bulk(self.cohort_id, variables=variables)
+
     def get_distributions(self, variable):
         """
         Get distribution statistics for a variable (e.g., age) in a specific cohort in BiasDatabase.
+        BiasDatabase caches the distributions until rows are added to the cohort
         """
         return self.bias_db.get_cohort_distributions(self.cohort_id, variable)
 
+    def age_report(self):
+        """
+        Get age statistics and age distribution of the cohort in BiasDatabase computed together in
+        one query, which is cheaper than calling get_stats('age') and get_distributions('age') separately
+        """
+        return self.bias_db.get_cohort_age_report(self.cohort_id)
+
     def get_concept_stats(self, concept_type='condition_occurrence', filter_count=0,
                           vocab=None):
         """
@@ -71,10 +91,7 @@ class CohortAction:
         Create a new cohort by executing a query on OMOP CDM database
         and storing the result in BiasDatabase.
         """
-        omop_session = self.omop_db.get_session()
         try:
-            # Execute read-only query from OMOP CDM database
-            result = self.omop_db.execute_query(query)
             # Create CohortDefinition
             cohort_def = CohortDefinition(
                 name=cohort_name,
@@ -85,23 +102,46 @@ class CohortAction:
             )
             cohort_def_id = self.bias_db.create_cohort_definition(cohort_def)
 
-            # Store cohort_definition and cohort data into BiasDatabase
-            for row in result:
-                cohort = Cohort(
-                    subject_id=int(row['person_id']),  # Assuming person_id column in the result
-                    cohort_definition_id=cohort_def_id,
-                    cohort_start_date=row['cohort_start_date'],
-                    cohort_end_date=row['cohort_end_date']
-                )
-                self.bias_db.create_cohort(cohort)
-            print(f"Cohort {cohort_name} successfully created.")
-            omop_session.close()
+            if self.bias_db.postgres_extension_loaded:
+                # run the read-only query on OMOP CDM database from DuckDB and insert the result directly
+                self.bias_db.ingest_cohort_from_postgres(cohort_def_id, query)
+            else:
+                # Execute read-only query from OMOP CDM database, streaming the result in columnar batches
+                # and storing each batch of cohort data into BiasDatabase in one bulk append
+                for batch_df in self.omop_db.execute_query_in_batches(query):
+                    self.bias_db.create_cohorts_bulk(pd.DataFrame({
+                        'subject_id': batch_df['person_id'],  # Assuming person_id column in the result
+                        'cohort_definition_id': cohort_def_id,
+                        'cohort_start_date': batch_df['cohort_start_date'],
+                        'cohort_end_date': batch_df['cohort_end_date']
+                    }))
+            logger.info("Cohort %s successfully created.", cohort_name)
+            return CohortData(cohort_id=cohort_def_id, bias_db=self.bias_db, omop_db=self.omop_db)
+        except duckdb.Error:
+            logger.exception("Error executing query")
+        except SQLAlchemyError:
+            logger.exception("Error executing query")
+
+    def create_cohort_from_parquet(self, cohort_name: str, description: str, parquet_path: str,
+                                   created_by: str):
+        """
+        Create a new cohort from a cohort query result exported to a Parquet file and store it
+        in BiasDatabase.
+        """
+        try:
+            cohort_def = CohortDefinition(
+                name=cohort_name,
+                description=description,
+                created_date=datetime.now().date(),
+                creation_info=f"read_parquet('{parquet_path}')",
+                created_by=created_by
+            )
+            cohort_def_id = self.bias_db.create_cohort_definition(cohort_def)
+            self.bias_db.ingest_cohort_from_parquet(cohort_def_id, parquet_path)
+            logger.info("Cohort %s successfully created.", cohort_name)
             return CohortData(cohort_id=cohort_def_id, bias_db=self.bias_db, omop_db=self.omop_db)
-        except duckdb.Error as e:
-            print(f"Error executing query: {e}")
-        except SQLAlchemyError as e:
-            print(f"Error executing query: {e}")
-            omop_session.close()
+        except duckdb.Error:
+            logger.exception("Error reading cohort from parquet file")
 
     def compare_cohorts(self, cohort_id_1: int, cohort_id_2: int):
         """
@@ -109,10 +149,10 @@ class CohortAction:
         """
         results = []
         for variable in self.bias_db.cohort_distribution_variables:
-            cohort_1_stats = self.bias_db.get_cohort_distributions(cohort_id_1, variable=variable)
-            cohort_2_stats = self.bias_db.get_cohort_distributions(cohort_id_2, variable=variable)
-            cohort_1_probs = [entry['probability'] for entry in cohort_1_stats]
-            cohort_2_probs = [entry['probability'] for entry in cohort_2_stats]
+            cohort_stats = self.bias_db.get_multi_cohort_distributions([cohort_id_1, cohort_id_2],
+                                                                       variable=variable)
+            cohort_1_probs = [entry['probability'] for entry in cohort_stats[int(cohort_id_1)]]
+            cohort_2_probs = [entry['probability'] for entry in cohort_stats[int(cohort_id_2)]]
             dist = hellinger_distance(cohort_1_probs, cohort_2_probs)
             results.append({
                 f'{variable}_hellinger_distance': dist
@@ -1,6 +1,10 @@
+import inspect
+import logging
+import functools
 import duckdb
 import pandas as pd
-from typing import Optional
+from typing import List, Optional
+from collections import OrderedDict
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
@@ -10,6 +14,39 @@ from biasanalyzer.sql import *
 from biasanalyzer.utils import build_concept_hierarchy, print_hierarchy, find_roots
 
 
+logger = logging.getLogger(__name__)
+
+
+def _log_errors(message):
+    """
+    Decorate a BiasDatabase getter so that it logs failures and returns None instead of raising. A
+    ValueError raised for invalid input is logged without a stack trace, any other exception with it.
+    message may refer to the getter's arguments by name, e.g., {variable}
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except ValueError as e:
+                logger.error("%s: %s", _format_message(signature, message, args, kwargs), e)
+                return None
+            except Exception:
+                logger.exception("%s", _format_message(signature, message, args, kwargs))
+                return None
+        return wrapper
+    return decorator
+
+
+def _format_message(signature, message, args, kwargs):
+    # only called once an error occurred, so formatting costs nothing on success
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return message.format(**bound.arguments)
+
+
 class BiasDatabase:
     distribution_queries = {
         "age": AGE_DISTRIBUTION_QUERY,
@@ -31,6 +68,34 @@ class BiasDatabase:
             'default_vocab': 'RxNorm'
         }
     }
+    # the cohort table is rewritten in cohort order once the rows inserted one at a time, possibly out of
+    # cohort order, reach this fraction of the table, and at least cohort_cluster_threshold of them, so
+    # that the cost of each rewrite is spread over a number of inserts proportional to the table size
+    cohort_cluster_threshold = 10000
+    cohort_cluster_fraction = 0.1
+    # cohorts with at most this many distinct subjects only pull their own person rows from an OMOP CDM
+    # postgreSQL database rather than scanning its whole person table
+    person_subset_threshold = 10000
+    # maximum number of cached stats and distribution results, each the few rows of one query for one
+    # cohort, beyond which the least recently used results are dropped
+    results_cache_size = 256
+    # DuckDB settings applied when connecting, a None value keeps DuckDB's default. Override before
+    # the first BiasDatabase is created, e.g. BiasDatabase.duckdb_settings['memory_limit'] = '8GB'
+    duckdb_settings = {
+        # None keeps DuckDB's default (all cores); listed only so it can be overridden
+        'threads': None,
+        'memory_limit': None,
+        # stats queries aggregate and cohort queries sort explicitly, so let DuckDB scan in parallel unordered
+        'preserve_insertion_order': False,
+        # reuse parquet and postgres metadata across queries
+        'enable_object_cache': True
+    }
+    # postgres_scanner settings applied once the extension is loaded
+    postgres_settings = {
+        # push WHERE filters down to postgreSQL instead of copying whole OMOP CDM tables
+        'pg_experimental_filter_pushdown': True
+    }
+    cohort_definition_columns = ('id', 'name', 'description', 'created_date', 'creation_info', 'created_by')
     _instance = None  # indicating a singleton with only one instance of the class ever created
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -41,60 +106,104 @@ class BiasDatabase:
     def _initialize(self, db_url):
         # by default, duckdb uses in memory database
         self.conn = duckdb.connect(db_url)
+        self._apply_settings(self.__class__.duckdb_settings)
         self.omop_cdm_db_url = None
-        self._create_cohort_definition_table()
-        self._create_cohort_table()
-
-    def _create_cohort_definition_table(self):
-        try:
-            self.conn.execute('CREATE SEQUENCE id_sequence START 1')
-        except duckdb.Error as e:
-            if "already exists" in str(e).lower():
-                print("Sequence already exists, skipping creation.")
-            else:
-                raise
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS cohort_definition (
-                      id INTEGER DEFAULT nextval('id_sequence'), 
-                      name VARCHAR NOT NULL, 
-                      description VARCHAR, 
-                      created_date DATE, 
-                      creation_info VARCHAR, 
-                      created_by VARCHAR,
-                      PRIMARY KEY (id)
-                      )
-                ''')
-        print("Cohort Definition table created.")
-
-    def _create_cohort_table(self):
-        self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS cohort (
-                subject_id BIGINT,
-                cohort_definition_id INTEGER,
-                cohort_start_date DATE,
-                cohort_end_date DATE,
-                FOREIGN KEY (cohort_definition_id) REFERENCES cohort_definition(id)
-            )
-        ''')
-        try:
+        self.postgres_extension_loaded = False
+        self._omop_cdm_db_attached = False
+        self._omop_tables_ready = set()  # OMOP CDM tables already exposed in BiasDatabase
+        self._create_tables()
+        self._cohort_person_ready = set()  # cohorts already joined with person in cohort_person table
+        self._unclustered_cohort_rows = 0
+        self._cluster_rows_needed = self.__class__.cohort_cluster_threshold
+        # row counts of cohorts created in this session, kept up to date as rows are inserted
+        self._cohort_sizes = {}
+        # query templates prepared in this session mapped to their result column names once known
+        self._prepared_statements = {}
+        # small stats and distribution results keyed by (cohort_definition_id, query name)
+        self._results_cache = OrderedDict()
+
+    def _create_tables(self):
+        # create the whole schema in one call rather than one execute per sequence, table, and index
+        self.conn.execute(BIAS_DB_SCHEMA)
+        logger.debug("BiasDatabase tables created.")
+
+    def _populate_cohort_person(self, cohort_definition_ids):
+        # only join cohorts that have not been joined with person since they were last modified
+        cohort_ids = [cid for cid in dict.fromkeys(int(cid) for cid in cohort_definition_ids)
+                      if cid not in self._cohort_person_ready]
+        # cohorts known to be empty have no rows to join, so skip the person scan for them
+        self._cohort_person_ready.update(cid for cid in cohort_ids if self._cohort_sizes.get(cid) == 0)
+        cohort_ids = [cid for cid in cohort_ids if cid not in self._cohort_person_ready]
+        if not cohort_ids:
+            return
+        if self.postgres_extension_loaded:
+            subject_ids = [row[0] for row in self.conn.execute('''
+                SELECT DISTINCT subject_id FROM cohort 
+                WHERE cohort_definition_id IN (SELECT UNNEST(?::INTEGER[]))
+            ''', (cohort_ids,)).fetchall()]
+            if len(subject_ids) <= self.__class__.person_subset_threshold:
+                # fetch only the cohort's own person rows from postgreSQL via its person_id index
+                if subject_ids:
+                    self._attach_omop_database()
+                    person_ids = ', '.join(str(int(sid)) for sid in subject_ids)
+                    self.conn.execute(COHORT_PERSON_SUBSET_INSERT_QUERY.format(person_ids=person_ids),
+                                      (cohort_ids,))
+                self._cohort_person_ready.update(cohort_ids)
+                return
+        self._execute_prepared('cohort_person_insert', COHORT_PERSON_INSERT_QUERY, cohort_ids)
+        self._cohort_person_ready.update(cohort_ids)
+
+    def _invalidate_cohort_caches(self, cohort_definition_ids):
+        """
+        Drop the cached person rows and query results of cohorts whose rows have just changed so that
+        they are recomputed on the next request, leaving the caches of other cohorts intact
+        """
+        changed_ids = set(cohort_definition_ids)
+        for key in [key for key in self._results_cache if key[0] in changed_ids]:
+            del self._results_cache[key]
+        cohort_ids = [cid for cid in changed_ids if cid in self._cohort_person_ready]
+        if cohort_ids:
             self.conn.execute('''
-                CREATE INDEX idx_cohort_dates ON cohort (cohort_definition_id, cohort_start_date, cohort_end_date);
-            ''')
-        except duckdb.Error as e:
-            if "already exists" in str(e).lower():
-                print("Index already exists, skipping creation.")
-            else:
-                raise
-        print("Cohort table created.")
+                DELETE FROM cohort_person WHERE cohort_definition_id IN (SELECT UNNEST(?::INTEGER[]))
+            ''', (cohort_ids,))
+            self._cohort_person_ready.difference_update(cohort_ids)
+
+    def _cohort_rows_inserted(self, row_counts: dict):
+        """
+        Update the known cohort sizes with the number of rows just inserted into each cohort and
+        invalidate the caches of the cohorts that actually received rows
+        :param row_counts: dict keyed by cohort definition id with the number of inserted rows
+        """
+        for cid, count in row_counts.items():
+            if cid in self._cohort_sizes:
+                self._cohort_sizes[cid] += count
+        self._invalidate_cohort_caches([cid for cid, count in row_counts.items() if count > 0])
 
     def load_postgres_extension(self):
         self.conn.execute("INSTALL postgres_scanner;")
         self.conn.execute("LOAD postgres_scanner;")
+        self._apply_settings(self.__class__.postgres_settings)
+        self.postgres_extension_loaded = True
+
+    def _apply_settings(self, settings: dict):
+        for name, value in settings.items():
+            if value is None:
+                continue
+            if isinstance(value, str):
+                value = "'" + value.replace("'", "''") + "'"
+            self.conn.execute(f"SET {name} = {value}")
+
+    def _attach_omop_database(self):
+        # attach OMOP CDM postgreSQL database once so that postgres_query can run queries against it
+        if not self._omop_cdm_db_attached:
+            self.conn.execute(f"ATTACH '{self.omop_cdm_db_url}' AS omop_cdm (TYPE POSTGRES, READ_ONLY)")
+            self._omop_cdm_db_attached = True
 
     def create_cohort_definition(self, cohort_definition: CohortDefinition):
-        self.conn.execute('''
+        result = self.conn.execute('''
             INSERT INTO cohort_definition (name, description, created_date, creation_info, created_by)
             VALUES (?, ?, ?, ?, ?)
+            RETURNING id
         ''', (
             cohort_definition.name,
             cohort_definition.description,
@@ -102,9 +211,9 @@ class BiasDatabase:
             cohort_definition.creation_info,
             cohort_definition.created_by
         ))
-        print("Cohort definition inserted successfully.")
-        self.conn.execute("SELECT id from cohort_definition ORDER BY id DESC LIMIT 1")
-        created_cohort_id = self.conn.fetchone()[0]
+        created_cohort_id = result.fetchone()[0]
+        self._cohort_sizes[created_cohort_id] = 0
+        logger.debug("Cohort definition inserted successfully.")
         return created_cohort_id
 
     # Method to insert cohort data
@@ -118,51 +227,281 @@ class BiasDatabase:
             cohort.cohort_start_date,
             cohort.cohort_end_date
         ))
+        self._cohort_rows_inserted({cohort.cohort_definition_id: 1})
+        self._unclustered_cohort_rows += 1
+        if self._unclustered_cohort_rows >= self._cluster_rows_needed:
+            # only count the table's rows once enough inserts have accumulated to possibly need a rewrite
+            total_rows = self.conn.execute('SELECT COUNT(*) FROM cohort').fetchone()[0]
+            self._cluster_rows_needed = max(self.__class__.cohort_cluster_threshold,
+                                            int(total_rows * self.__class__.cohort_cluster_fraction))
+            if self._unclustered_cohort_rows >= self._cluster_rows_needed:
+                self._cluster_cohort_table()
+
+    def _cluster_cohort_table(self):
+        """
+        Rewrite the cohort table ordered by cohort definition id. Bulk inserts append one cohort at a
+        time, which keeps each cohort in its own row groups so DuckDB's min-max zonemaps can skip
+        the row groups of other cohorts when filtering on cohort_definition_id. Interleaved single-row
+        inserts break that layout, so it is restored once enough of them have accumulated.
+        """
+        self.conn.begin()
+        try:
+            self.conn.execute('''
+                CREATE TEMP TABLE cohort_sorted AS 
+                SELECT * FROM cohort ORDER BY cohort_definition_id, subject_id
+            ''')
+            self.conn.execute('DELETE FROM cohort')
+            # ORDER BY again since preserve_insertion_order may be off
+            self.conn.execute('''
+                INSERT INTO cohort SELECT * FROM cohort_sorted ORDER BY cohort_definition_id, subject_id
+            ''')
+            self.conn.execute('DROP TABLE cohort_sorted')
+            self.conn.commit()
+        except duckdb.Error:
+            self.conn.rollback()
+            raise
+        self._unclustered_cohort_rows = 0
+
+    def create_cohorts(self, cohorts: List[Cohort]):
+        """
+        Insert multiple cohort records in one bulk append, the batch counterpart of create_cohort
+        """
+        self.create_cohorts_bulk([
+            (cohort.subject_id, cohort.cohort_definition_id, cohort.cohort_start_date, cohort.cohort_end_date)
+            for cohort in cohorts
+        ])
+
+    def create_cohorts_bulk(self, rows):
+        """
+        Insert cohort data in bulk with a single columnar append instead of one INSERT per row.
+        :param rows: pandas DataFrame with subject_id, cohort_definition_id, cohort_start_date, and
+        cohort_end_date columns, or iterable of (subject_id, cohort_definition_id, cohort_start_date,
+        cohort_end_date) tuples
+        """
+        if isinstance(rows, pd.DataFrame):
+            cohort_df = rows
+        else:
+            cohort_df = pd.DataFrame(rows, columns=['subject_id', 'cohort_definition_id',
+                                                    'cohort_start_date', 'cohort_end_date'])
+        if cohort_df.empty:
+            return
+        self.conn.register('tmp_cohort', cohort_df)
+        try:
+            self.conn.execute('''
+                INSERT INTO cohort (subject_id, cohort_definition_id, cohort_start_date, cohort_end_date)
+                SELECT CAST(subject_id AS BIGINT), CAST(cohort_definition_id AS INTEGER),
+                       CAST(cohort_start_date AS DATE), CAST(cohort_end_date AS DATE)
+                FROM tmp_cohort
+            ''')
+        finally:
+            self.conn.unregister('tmp_cohort')
+        self._cohort_rows_inserted({int(cid): int(count) for cid, count in
+                                    cohort_df['cohort_definition_id'].value_counts().items()})
+
+    def ingest_cohort_from_postgres(self, cohort_definition_id: int, omop_query: str):
+        """
+        Insert cohort data by running the cohort query on the OMOP CDM postgreSQL database from
+        within DuckDB, so that the query result streams into the cohort table without being
+        materialized in Python.
+        :param cohort_definition_id: cohort definition id the inserted cohort rows belong to
+        :param omop_query: cohort query returning person_id, cohort_start_date, and cohort_end_date columns
+        """
+        self._attach_omop_database()
+        omop_query = omop_query.strip().rstrip(';').replace("'", "''")
+        inserted = self.conn.execute(f'''
+            INSERT INTO cohort (subject_id, cohort_definition_id, cohort_start_date, cohort_end_date)
+            SELECT person_id, ?, cohort_start_date, cohort_end_date
+            FROM postgres_query('omop_cdm', '{omop_query}')
+        ''', (cohort_definition_id,)).fetchone()[0]
+        self._cohort_rows_inserted({cohort_definition_id: inserted})
+
+    def ingest_cohort_from_parquet(self, cohort_definition_id: int, parquet_path: str):
+        """
+        Insert cohort data from a Parquet file holding a cohort query result, e.g., exported from the
+        OMOP CDM database with COPY ... TO ... (FORMAT PARQUET), so that repeated cohort builds read the
+        columnar file directly instead of re-running the query.
+        :param cohort_definition_id: cohort definition id the inserted cohort rows belong to
+        :param parquet_path: path to a Parquet file with person_id, cohort_start_date, and cohort_end_date columns
+        """
+        inserted = self.conn.execute('''
+            INSERT INTO cohort (subject_id, cohort_definition_id, cohort_start_date, cohort_end_date)
+            SELECT person_id, ?, cohort_start_date, cohort_end_date
+            FROM read_parquet(?)
+        ''', (cohort_definition_id, parquet_path)).fetchone()[0]
+        self._cohort_rows_inserted({cohort_definition_id: inserted})
 
     def get_cohort_definition(self, cohort_definition_id):
-        results = self.conn.execute(f'''
-        SELECT id, name, description, created_date, creation_info, created_by FROM cohort_definition 
-        WHERE id = {cohort_definition_id} 
-        ''')
-        headers = [desc[0] for desc in results.description]
-        row = results.fetchall()
-        if len(row) == 0:
+        row = self._execute_prepared('cohort_definition', COHORT_DEFINITION_QUERY, cohort_definition_id).fetchone()
+        if row is None:
             return {}
         else:
-            return dict(zip(headers, row[0]))
+            return dict(zip(self.__class__.cohort_definition_columns, row))
 
     def get_cohort(self, cohort_definition_id):
-        results = self.conn.execute(f'''
-        SELECT subject_id, cohort_definition_id, cohort_start_date, cohort_end_date FROM cohort 
-        WHERE cohort_definition_id = {cohort_definition_id}
-        ''')
-        headers = [desc[0] for desc in results.description]
-        rows = results.fetchall()
-        return [dict(zip(headers, row)) for row in rows]
+        """
+        Get the cohort data as a pandas DataFrame, which is built column by column from DuckDB
+        rather than by allocating a dict per cohort row
+        """
+        return self._execute_prepared('cohort', COHORT_QUERY, cohort_definition_id).fetchdf()
+
+    def get_cohort_rel(self, cohort_definition_id):
+        """
+        Get the cohort data as a lazy DuckDB relation, which callers can filter, aggregate, or convert
+        with .df() without the rows crossing into Python first
+        """
+        return self._cohort_relation(COHORT_QUERY, cohort_definition_id)
+
+    def get_cohort_in_batches(self, cohort_definition_id, batch_size=100000):
+        """
+        Get the cohort data as pandas DataFrames of about batch_size rows each, so that a large cohort
+        can be processed without holding all of its rows in memory at once. The rows are streamed
+        from a cursor of their own so that other BiasDatabase queries can run while they are consumed.
+        :param cohort_definition_id: cohort definition id representing the cohort
+        :param batch_size: number of rows per batch, rounded down to whole DuckDB vectors of 2048 rows
+        """
+        with self.conn.cursor() as cursor:
+            results = cursor.execute(COHORT_QUERY, [cohort_definition_id])
+            vectors_per_batch = max(1, batch_size // 2048)
+            while True:
+                batch_df = results.fetch_df_chunk(vectors_per_batch)
+                if batch_df.empty:
+                    break
+                yield batch_df
 
     def _create_omop_table(self, table_name):
-        if self.omop_cdm_db_url is not None and not self.omop_cdm_db_url.endswith('.duckdb'):
-            # need to create person table from OMOP CDM postgreSQL database
-            self.conn.execute(f"""
-                CREATE TABLE IF NOT EXISTS {table_name} AS 
-                SELECT * from postgres_scan('{self.omop_cdm_db_url}', 'public', {table_name})
-            """)
-            return True # success
-        elif self.omop_cdm_db_url.endswith('.duckdb'):
-            return True
-        else:
+        if self.omop_cdm_db_url is None:
             return False # failure
+        if self.omop_cdm_db_url.endswith('.duckdb') or table_name in self._omop_tables_ready:
+            return True
+        # expose the table from the attached OMOP CDM postgreSQL database as a view rather than copying
+        # it, so only the columns and rows a query actually needs are pulled from postgreSQL over the
+        # attached database's cached connections
+        self._attach_omop_database()
+        self.conn.execute(f"""
+            CREATE OR REPLACE VIEW {table_name} AS 
+            SELECT * from omop_cdm.public.{table_name}
+        """)
+        self._omop_tables_ready.add(table_name)
+        return True # success
+
+    def _execute_prepared(self, name, query_str, cohort_ids):
+        """
+        Execute a query template with a cohort definition id or a list of cohort definition ids as its
+        only parameter through a DuckDB prepared statement, so that the template is parsed and planned
+        once per session instead of on every call.
+        """
+        if name not in self._prepared_statements:
+            self.conn.execute(f'PREPARE {name} AS {query_str}')
+            self._prepared_statements[name] = None
+        # EXECUTE does not accept bound parameters, so ids are inlined as literals
+        return self.conn.execute(f'EXECUTE {name}({self._cohort_ids_literal(cohort_ids)})')
+
+    @staticmethod
+    def _cohort_ids_literal(cohort_ids):
+        # ids are coerced to int so that inlining them into SQL is safe
+        if isinstance(cohort_ids, (list, tuple)):
+            return f"[{', '.join(str(int(cid)) for cid in cohort_ids)}]"
+        return str(int(cohort_ids))
+
+    def _cohort_relation(self, query_str, cohort_ids):
+        """
+        Build a lazy DuckDB relation from a query template taking a cohort definition id or a list of
+        cohort definition ids as its only parameter. DuckDB runs a query with bound parameters right
+        away, so the ids are inlined instead to keep the relation lazy.
+        """
+        # the ids replace the template's placeholder textually, so any other ? would be replaced as well
+        if query_str.count('?') != 1:
+            raise ValueError("Query template for a cohort relation must contain exactly one ? placeholder")
+        return self.conn.sql(query_str.replace('?', self._cohort_ids_literal(cohort_ids)))
+
+    def _query_prepared(self, name, query_str, cohort_ids):
+        """
+        Execute a query template through a prepared statement and return its rows as dicts, reusing
+        the column names recorded the first time the template ran
+        """
+        results = self._execute_prepared(name, query_str, cohort_ids)
+        headers = self._prepared_statements[name]
+        if headers is None:
+            headers = self._prepared_statements[name] = [desc[0] for desc in results.description]
+        return self._fetch_dicts(results, headers)
 
-    def _execute_query(self, query_str):
-        results = self.conn.execute(query_str)
+    def _execute_multi_cohort_query(self, name, query_str, cohort_definition_ids, uses_person=False):
+        """
+        Execute a query covering several cohorts in one round trip and split the result rows by
+        cohort definition id. The query must take the list of cohort definition ids as its only
+        parameter and return a cohort_definition_id column. Results are cached per cohort so that
+        only cohorts without a cached result are queried; set uses_person if the query reads the
+        cohort_person table so that it is populated for those cohorts first.
+        """
+        # deduplicate ids so that comparing a cohort with itself does not count its rows twice, and key
+        # results by int ids as returned in the cohort_definition_id column
+        cohort_ids = list(dict.fromkeys(int(cid) for cid in cohort_definition_ids))
+        results = {cid: self._cached_rows((cid, name)) for cid in cohort_ids
+                   if (cid, name) in self._results_cache}
+        missing_ids = [cid for cid in cohort_ids if cid not in results]
+        if missing_ids:
+            if uses_person:
+                self._populate_cohort_person(missing_ids)
+            missing_results = {cid: [] for cid in missing_ids}
+            for row in self._query_prepared(name, query_str, missing_ids):
+                missing_results[row.pop('cohort_definition_id')].append(row)
+            for cid, rows in missing_results.items():
+                results[cid] = self._cache_rows((cid, name), rows)
+        return {cid: results[cid] for cid in cohort_ids}
+
+    def _cached_rows(self, key):
+        # hand out copies so that callers modifying a result cannot alter the cached rows
+        self._results_cache.move_to_end(key)
+        return [dict(row) for row in self._results_cache[key]]
+
+    def _cache_rows(self, key, rows):
+        # store a query result, dropping the least recently used results beyond results_cache_size,
+        # and return a copy of it for the caller
+        self._results_cache[key] = rows
+        self._results_cache.move_to_end(key)
+        while len(self._results_cache) > self.__class__.results_cache_size:
+            self._results_cache.popitem(last=False)
+        return [dict(row) for row in rows]
+
+    def _query_cohort_cached(self, name, query_str, cohort_definition_id):
+        """
+        Execute a single cohort query template on the cohort_person table through _query_prepared,
+        returning the cached result rows instead if the cohort has not changed since they were computed
+        """
+        key = (int(cohort_definition_id), name)
+        if key in self._results_cache:
+            return self._cached_rows(key)
+        self._populate_cohort_person([cohort_definition_id])
+        return self._cache_rows(key, self._query_prepared(name, query_str, cohort_definition_id))
 
-        headers = [desc[0] for desc in results.description]
+    def _execute_query(self, query_str, params=None, return_format='dict'):
+        """
+        Execute a query and return its result as a list of row dicts, which suits small results such
+        as stats, or with return_format='df' as a pandas DataFrame fetched in columnar form, which
+        suits queries that can return many rows. The query runs on its own cursor over the same
+        database, so it cannot read session state such as prepared statements. Only the concept stats
+        query goes through here; the other stats, insert and cache paths share self.conn and unlocked
+        session state, so BiasDatabase as a whole is not thread-safe.
+        """
+        if return_format not in ('dict', 'df'):
+            raise ValueError(f"Unsupported return format '{return_format}'. Valid formats are 'dict' and 'df'")
+        with self.conn.cursor() as cursor:
+            results = cursor.execute(query_str, params)
+            if return_format == 'df':
+                return results.fetchdf()
+            return self._fetch_dicts(results)
+
+    @staticmethod
+    def _fetch_dicts(results, headers=None):
+        if headers is None:
+            headers = [desc[0] for desc in results.description]
         rows = results.fetchall()
         if len(rows) == 0:
             return []
         else:
             return [dict(zip(headers, row)) for row in rows]
 
+    @_log_errors("Error computing cohort basic statistics")
     def get_cohort_basic_stats(self, cohort_definition_id: int, variable=''):
         """
         Get aggregation statistics for a cohort from the cohort table.
@@ -172,49 +511,85 @@ class BiasDatabase:
         the stats of the specified variable in the cohort are returned
         :return: cohort stats corresponding to the specified variable
         """
-        try:
-            if variable:
-                if self._create_omop_table('person'):
-                    query_str = self.__class__.stats_queries.get(variable)
-                    if query_str is None:
-                        raise ValueError(f"Statistics for variable '{variable}' is not available. "
-                                         f"Valid variables are {self.__class__.stats_queries.keys()}")
-                    stats_query = query_str.format(cohort_definition_id)
-                else:
-                    print("Cannot connect to the OMOP database to query person table")
-                    return None
+        if variable:
+            if self._create_omop_table('person'):
+                query_str = self.__class__.stats_queries.get(variable)
+                if query_str is None:
+                    raise ValueError(f"Statistics for variable '{variable}' is not available. "
+                                     f"Valid variables are {self.__class__.stats_queries.keys()}")
+                return self._query_cohort_cached(f'stats_{variable}', query_str, cohort_definition_id)
             else:
-                # Query the cohort data to get basic statistics
-                stats_query = f'''
-                    WITH cohort_Duration AS (
-                        SELECT
-                            subject_id,
-                            cohort_start_date,
-                            cohort_end_date,
-                            cohort_end_date - cohort_start_date AS duration_days
-                        FROM
-                            cohort
-                        WHERE cohort_definition_id = {cohort_definition_id}    
-                    )
-                    SELECT
-                        COUNT(*) AS total_count,
-                        MIN(cohort_start_date) AS earliest_start_date,
-                        MAX(cohort_start_date) AS latest_start_date,
-                        MIN(cohort_end_date) AS earliest_end_date,
-                        MAX(cohort_end_date) AS latest_end_date,
-                        MIN(duration_days) AS min_duration_days,
-                        MAX(duration_days) AS max_duration_days,
-                        ROUND(AVG(duration_days), 2) AS avg_duration_days,
-                        CAST(PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY duration_days) AS INT) AS median_duration,
-                        ROUND(STDDEV(duration_days), 2) AS stddev_duration
-                    FROM cohort_Duration                    
-                '''
-            return self._execute_query(stats_query)
-
-        except Exception as e:
-            print(f"Error computing cohort basic statistics: {e}")
+                logger.warning("Cannot connect to the OMOP database to query person table")
+                return None
+        else:
+            # Query the cohort data to get basic statistics
+            return self._execute_multi_cohort_query('cohort_basic_stats', COHORT_BASIC_STATS_QUERY,
+                                                    [cohort_definition_id])[int(cohort_definition_id)]
+
+    @_log_errors("Error computing cohort basic statistics")
+    def get_cohort_basic_stats_rel(self, cohort_definition_id: int, variable=''):
+        """
+        Get aggregation statistics for a cohort as a lazy DuckDB relation rather than a list of dicts,
+        see get_cohort_basic_stats. The cohort is joined with person each time the relation runs, so
+        it reflects rows added to the cohort after it was built.
+        :param cohort_definition_id: cohort definition id representing the cohort
+        :param variable: optional with an empty string as default, see get_cohort_basic_stats
+        :return: DuckDB relation with the cohort stats corresponding to the specified variable
+        """
+        if not variable:
+            return self._cohort_relation(COHORT_BASIC_STATS_QUERY, [cohort_definition_id]).select(
+                '* EXCLUDE (cohort_definition_id)')
+        if self._create_omop_table('person'):
+            query_str = self.__class__.stats_queries.get(variable)
+            if query_str is None:
+                raise ValueError(f"Statistics for variable '{variable}' is not available. "
+                                 f"Valid variables are {self.__class__.stats_queries.keys()}")
+            return self._cohort_relation(COHORT_PERSON_LIVE_QUERY.format(query=query_str), cohort_definition_id)
+        else:
+            logger.warning("Cannot connect to the OMOP database to query person table")
             return None
 
+    @_log_errors("Error computing cohort basic statistics")
+    def get_cohort_stats_bulk(self, cohort_definition_id: int, variables=('age', 'gender', 'race', 'ethnicity')):
+        """
+        Get the statistics of several variables for a cohort with a single query rather than calling
+        get_cohort_basic_stats once per variable.
+        :param cohort_definition_id: cohort definition id representing the cohort
+        :param variables: variables such as age, gender, race, and ethnicity to get stats for
+        :return: dict keyed by variable with the stats of the variable in the cohort
+        """
+        if not self._create_omop_table('person'):
+            logger.warning("Cannot connect to the OMOP database to query person table")
+            return None
+        cohort_definition_id = int(cohort_definition_id)
+        for variable in variables:
+            if variable not in self.__class__.stats_queries:
+                raise ValueError(f"Statistics for variable '{variable}' is not available. "
+                                 f"Valid variables are {self.__class__.stats_queries.keys()}")
+        results = {variable: self._cached_rows((cohort_definition_id, f'stats_{variable}'))
+                   for variable in variables if (cohort_definition_id, f'stats_{variable}') in self._results_cache}
+        missing_vars = [variable for variable in dict.fromkeys(variables) if variable not in results]
+        if missing_vars:
+            self._populate_cohort_person([cohort_definition_id])
+            query_str = 'SELECT ' + ', '.join(
+                STATS_BULK_COLUMN.format(query=self.__class__.stats_queries[variable], variable=variable)
+                for variable in missing_vars)
+            row = self.conn.execute(query_str, [cohort_definition_id] * len(missing_vars)).fetchone()
+            for variable, rows in zip(missing_vars, row):
+                # LIST over no rows is NULL
+                results[variable] = self._cache_rows((cohort_definition_id, f'stats_{variable}'), rows or [])
+        return {variable: results[variable] for variable in variables}
+
+    @_log_errors("Error computing cohort basic statistics")
+    def get_multi_cohort_basic_stats(self, cohort_definition_ids: list):
+        """
+        Get aggregation statistics for multiple cohorts from the cohort table with a single query.
+        :param cohort_definition_ids: list of cohort definition ids representing the cohorts
+        :return: dict keyed by int cohort definition id with the cohort stats of each cohort
+        """
+        return self._execute_multi_cohort_query('cohort_basic_stats', COHORT_BASIC_STATS_QUERY,
+                                                cohort_definition_ids)
+
     @property
     def cohort_distribution_variables(self):
         return self.__class__.distribution_queries.keys()
@@ -223,19 +598,70 @@ class BiasDatabase:
         """
         Get age distribution statistics for a cohort from the cohort table.
         """
-        try:
-            if self._create_omop_table('person'):
-                query_str = self.__class__.distribution_queries.get(variable)
-                if query_str is None:
-                    raise ValueError(f"Distribution for variable '{variable}' is not available. "
-                                     f"Valid variables are {self.__class__.distribution_queries.keys()}")
-                query = query_str.format(cohort_definition_id)
-                return self._execute_query(query)
-            else:
-                print("Cannot connect to the OMOP database to query person table")
-                return None
-        except Exception as e:
-            print(f"Error computing cohort {variable} distributions: {e}")
+        distributions = self.get_multi_cohort_distributions([cohort_definition_id], variable)
+        return None if distributions is None else distributions[int(cohort_definition_id)]
+
+    @_log_errors("Error computing cohort {variable} distributions")
+    def get_cohort_distributions_rel(self, cohort_definition_id: int, variable: str):
+        """
+        Get distribution statistics of a variable for a cohort as a lazy DuckDB relation rather than a
+        list of dicts, see get_cohort_distributions. The cohort is joined with person each time the
+        relation runs, so it reflects rows added to the cohort after it was built.
+        """
+        if self._create_omop_table('person'):
+            query_str = self.__class__.distribution_queries.get(variable)
+            if query_str is None:
+                raise ValueError(f"Distribution for variable '{variable}' is not available. "
+                                 f"Valid variables are {self.__class__.distribution_queries.keys()}")
+            return self._cohort_relation(COHORT_PERSON_LIVE_QUERY.format(query=query_str),
+                                         [cohort_definition_id]).select(
+                '* EXCLUDE (cohort_definition_id)')
+        else:
+            logger.warning("Cannot connect to the OMOP database to query person table")
+            return None
+
+    @_log_errors("Error computing cohort {variable} distributions")
+    def get_multi_cohort_distributions(self, cohort_definition_ids: list, variable: str):
+        """
+        Get distribution statistics of a variable for multiple cohorts from the cohort table with
+        a single query.
+        :param cohort_definition_ids: list of cohort definition ids representing the cohorts
+        :param variable: variable such as age or gender to get distributions for
+        :return: dict keyed by cohort definition id with the variable distribution of each cohort
+        """
+        if self._create_omop_table('person'):
+            query_str = self.__class__.distribution_queries.get(variable)
+            if query_str is None:
+                raise ValueError(f"Distribution for variable '{variable}' is not available. "
+                                 f"Valid variables are {self.__class__.distribution_queries.keys()}")
+            return self._execute_multi_cohort_query(f'distribution_{variable}', query_str,
+                                                    cohort_definition_ids, uses_person=True)
+        else:
+            logger.warning("Cannot connect to the OMOP database to query person table")
+            return None
+
+    @_log_errors("Error computing cohort age report")
+    def get_cohort_age_report(self, cohort_definition_id: int):
+        """
+        Get age statistics and age distribution of a cohort computed together in a single pass over
+        the cohort, in the same formats as get_cohort_basic_stats and get_cohort_distributions return
+        them for the age variable.
+        :param cohort_definition_id: cohort definition id representing the cohort
+        :return: dict with the age statistics under 'stats' and the age distribution under 'distribution'
+        """
+        if self._create_omop_table('person'):
+            rows = self._query_cohort_cached('age_report', AGE_REPORT_QUERY, cohort_definition_id)
+            report = {'stats': [], 'distribution': []}
+            for row in rows:
+                if row['is_total']:
+                    report['stats'].append({key: row[key] for key in (
+                        'total_count', 'min_age', 'max_age', 'avg_age', 'median_age', 'stddev_age')})
+                else:
+                    report['distribution'].append({key: row[key] for key in (
+                        'age_bin', 'bin_count', 'probability')})
+            return report
+        else:
+            logger.warning("Cannot connect to the OMOP database to query person table")
             return None
 
     def get_cohort_concept_stats(self, cohort_definition_id: int,
@@ -245,8 +671,8 @@ class BiasDatabase:
         """
         concept_stats = {}
         if concept_type not in self.__class__.cohort_concept_queries:
-            print(f"input {concept_type} is not a valid concept type. "
-                  f"Supported concept types are: {self.__class__.cohort_concept_queries.keys()}")
+            logger.warning("input %s is not a valid concept type. Supported concept types are: %s",
+                           concept_type, list(self.__class__.cohort_concept_queries.keys()))
             return concept_stats
         try:
             if self._create_omop_table('concept') and self._create_omop_table('concept_ancestor'):
@@ -272,24 +698,38 @@ class BiasDatabase:
                         print_hierarchy(hierarchy, parent=root, level=0, parent_details=root_detail)
                     return concept_stats
                 else:
-                    print(f"Cannot connect to the OMOP database to query {concept_type} table")
+                    logger.warning("Cannot connect to the OMOP database to query %s table", concept_type)
                     return concept_stats
             else:
-                print("Cannot connect to the OMOP database to query concept table")
+                logger.warning("Cannot connect to the OMOP database to query concept table")
                 return concept_stats
-        except Exception as e:
-            print(f"Error computing cohort concept stats: {e}")
+        except Exception:
+            logger.exception("Error computing cohort concept stats")
             return concept_stats
 
     def close(self):
         self.conn.close()
+        # drop session state tied to the closed connection so that nothing stale is reused
+        self._prepared_statements.clear()
+        self._omop_tables_ready.clear()
+        self._cohort_person_ready.clear()
+        self._results_cache.clear()
+        self._cohort_sizes.clear()
+        self._omop_cdm_db_attached = False
         BiasDatabase._instance = None
-        print("Connection to BiasDatabase closed.")
+        logger.info("Connection to BiasDatabase closed.")
 
 
 class OMOPCDMDatabase:
     _instance = None  # indicating a singleton with only one instance of the class ever created
     _database_type = None
+    # connection pool options of the SQLAlchemy engine for an OMOP CDM postgreSQL database
+    engine_options = {
+        'pool_size': 8,
+        'max_overflow': 4,
+        'pool_pre_ping': True,  # check pooled connections before use instead of failing mid-query
+        'pool_recycle': 1800  # replace connections older than 30 minutes before servers or proxies drop them
+    }
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super(OMOPCDMDatabase, cls).__new__(cls)
@@ -301,22 +741,24 @@ class OMOPCDMDatabase:
             # Handle DuckDB connection
             try:
                 self.engine = duckdb.connect(db_url)
-                print(f"Connected to the DuckDB database: {db_url}.")
-            except duckdb.Error as e:
-                print(f"Failed to connect to DuckDB: {e}")
+                logger.info("Connected to the DuckDB database: %s.", db_url)
+            except duckdb.Error:
+                logger.exception("Failed to connect to DuckDB")
             self.Session = self.engine  # Use engine directly for DuckDB
             self._database_type = 'duckdb'
+            return
         try:
             self.engine = create_engine(
                 db_url,
                 echo=False,
+                **self.__class__.engine_options,
                 connect_args={'options': '-c default_transaction_read_only=on'}  # Enforce read-only transactions
             )
             self.Session = sessionmaker(bind=self.engine)
-            print("Connected to the OMOP CDM database (read-only).")
+            logger.info("Connected to the OMOP CDM database (read-only).")
             self._database_type = 'postgresql'
-        except SQLAlchemyError as e:
-            print(f"Failed to connect to the database: {e}")
+        except SQLAlchemyError:
+            logger.exception("Failed to connect to the database")
 
     def get_session(self):
         if self._database_type == 'duckdb':
@@ -328,9 +770,11 @@ class OMOPCDMDatabase:
     def execute_query(self, query, params=None):
         try:
             if self._database_type == 'duckdb':
-                # DuckDB query execution
-                results = self.engine.execute(query, params).fetchall()
-                headers = [desc[0] for desc in self.engine.execute(query, params).description]
+                # DuckDB query execution, taking the rows and column names from the same result
+                # rather than running the query a second time for its description
+                results = self.engine.execute(query, params)
+                headers = [desc[0] for desc in results.description]
+                results = results.fetchall()
             else:
                 # PostgreSQL query execution
                 omop_session = self.get_session()
@@ -342,14 +786,41 @@ class OMOPCDMDatabase:
 
             return [dict(zip(headers, row)) for row in results]
 
-        except duckdb.Error as e:
-            print(f"Error executing query: {e}")
+        except duckdb.Error:
+            logger.exception("Error executing query")
             return []
-        except SQLAlchemyError as e:
-            print(f"Error executing query: {e}")
+        except SQLAlchemyError:
+            logger.exception("Error executing query")
             omop_session.close()
             return []
 
+    def execute_query_in_batches(self, query, params=None, batch_size=10000):
+        """
+        Execute a query and yield its result as pandas DataFrames of about batch_size rows each, so that
+        large results such as cohort query results are streamed in columnar batches rather than fetched
+        into memory all at once. Unlike execute_query, errors are raised to the caller.
+        """
+        if self._database_type == 'duckdb':
+            results = self.engine.execute(query, params)
+            # DuckDB fetches whole vectors of 2048 rows at a time
+            vectors_per_batch = max(1, batch_size // 2048)
+            while True:
+                batch_df = results.fetch_df_chunk(vectors_per_batch)
+                if batch_df.empty:
+                    break
+                yield batch_df
+        else:
+            # PostgreSQL query execution with a server-side cursor on a plain Core connection, since an
+            # ORM session adds nothing for a single read-only query
+            with self.engine.connect() as conn:
+                results = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+                    text(query), params)
+                headers = list(results.keys())
+                # pass the size explicitly since yield_per alone does not size Core result partitions
+                # on every dialect
+                for rows in results.partitions(batch_size):
+                    yield pd.DataFrame(rows, columns=headers)
+
     def get_domains_and_vocabularies(self) -> list:
         # find a concept ID based on a search term
         query = """
@@ -465,4 +936,4 @@ class OMOPCDMDatabase:
         else:
             self.engine.dispose()
         OMOPCDMDatabase._instance = None
-        print("Connection to the OMOP CDM database closed.")
+        logger.info("Connection to the OMOP CDM database closed.")
@@ -1,81 +1,295 @@
 # SQL templates for querying in OMOP database
 
-AGE_DISTRIBUTION_QUERY = '''
-    WITH Age_Cohort AS (
-        SELECT p.person_id, EXTRACT(YEAR FROM c.cohort_start_date) - p.year_of_birth AS age 
+# BiasDatabase schema created in a single multi-statement call when connecting
+BIAS_DB_SCHEMA = '''
+    CREATE SEQUENCE IF NOT EXISTS id_sequence START 1;
+    CREATE TABLE IF NOT EXISTS cohort_definition (
+        id INTEGER DEFAULT nextval('id_sequence'), 
+        name VARCHAR NOT NULL, 
+        description VARCHAR, 
+        created_date DATE, 
+        creation_info VARCHAR, 
+        created_by VARCHAR,
+        PRIMARY KEY (id)
+    );
+    CREATE TABLE IF NOT EXISTS cohort (
+        subject_id BIGINT,
+        cohort_definition_id INTEGER,
+        cohort_start_date DATE,
+        cohort_end_date DATE,
+        FOREIGN KEY (cohort_definition_id) REFERENCES cohort_definition(id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_cohort_dates ON cohort (cohort_definition_id, cohort_start_date, cohort_end_date);
+    -- single-column ART index that DuckDB can use for index scans on the cohort_definition_id = ?
+    -- filter every cohort-scoped query applies, which the composite index above does not serve
+    CREATE INDEX IF NOT EXISTS idx_cohort_defid ON cohort (cohort_definition_id);
+    -- per-session cache of each analyzed cohort joined with person demographics, so that the
+    -- age, gender, race, and ethnicity queries do not repeat the cohort-person join
+    CREATE TEMP TABLE IF NOT EXISTS cohort_person (
+        cohort_definition_id INTEGER,
+        person_id BIGINT,
+        age BIGINT,
+        gender_concept_id INTEGER,
+        race_concept_id INTEGER,
+        ethnicity_concept_id INTEGER
+    );
+'''
+
+COHORT_DEFINITION_QUERY = '''
+    SELECT id, name, description, created_date, creation_info, created_by FROM cohort_definition 
+    WHERE id = ?
+'''
+
+COHORT_QUERY = '''
+    SELECT subject_id, cohort_definition_id, cohort_start_date, cohort_end_date FROM cohort 
+    WHERE cohort_definition_id = ?
+    ORDER BY subject_id
+'''
+
+COHORT_PERSON_INSERT_QUERY = '''
+    INSERT INTO cohort_person
+    SELECT 
+        c.cohort_definition_id,
+        p.person_id, 
+        EXTRACT(YEAR FROM c.cohort_start_date) - p.year_of_birth AS age,
+        p.gender_concept_id,
+        p.race_concept_id,
+        p.ethnicity_concept_id
+    FROM cohort c JOIN person p ON c.subject_id = p.person_id
+    WHERE c.cohort_definition_id IN (SELECT UNNEST(?::INTEGER[]))
+'''
+
+# runs a query template reading cohort_person on the cohort joined with person at execution time
+# instead of on the cohort_person session cache, for relations that may run after the cohort changed
+COHORT_PERSON_LIVE_QUERY = '''
+    WITH cohort_person AS (
+        SELECT 
+            c.cohort_definition_id,
+            p.person_id, 
+            EXTRACT(YEAR FROM c.cohort_start_date) - p.year_of_birth AS age,
+            p.gender_concept_id,
+            p.race_concept_id,
+            p.ethnicity_concept_id
         FROM cohort c JOIN person p ON c.subject_id = p.person_id
-        WHERE c.cohort_definition_id = {}
+    )
+    SELECT * FROM ({query}) q
+'''
+
+# same as COHORT_PERSON_INSERT_QUERY, but only pulls the person rows of the given person ids from the
+# attached OMOP CDM postgreSQL database instead of scanning its whole person table
+COHORT_PERSON_SUBSET_INSERT_QUERY = '''
+    INSERT INTO cohort_person
+    SELECT 
+        c.cohort_definition_id,
+        p.person_id, 
+        EXTRACT(YEAR FROM c.cohort_start_date) - p.year_of_birth AS age,
+        p.gender_concept_id,
+        p.race_concept_id,
+        p.ethnicity_concept_id
+    FROM cohort c JOIN postgres_query('omop_cdm', '
+        SELECT person_id, year_of_birth, gender_concept_id, race_concept_id, ethnicity_concept_id
+        FROM public.person WHERE person_id IN ({person_ids})
+    ') p ON c.subject_id = p.person_id
+    WHERE c.cohort_definition_id IN (SELECT UNNEST(?::INTEGER[]))
+'''
+
+COHORT_BASIC_STATS_QUERY = '''
+    WITH Cohort_Ids AS (
+        SELECT UNNEST(?::INTEGER[]) AS cohort_definition_id
+    ),
+    cohort_Duration AS (
+        SELECT
+            cohort_definition_id,
+            subject_id,
+            cohort_start_date,
+            cohort_end_date,
+            cohort_end_date - cohort_start_date AS duration_days
+        FROM
+            cohort
+        WHERE cohort_definition_id IN (SELECT cohort_definition_id FROM Cohort_Ids)
+    )
+    SELECT
+        ci.cohort_definition_id,
+        COUNT(cd.cohort_definition_id) AS total_count,
+        MIN(cd.cohort_start_date) AS earliest_start_date,
+        MAX(cd.cohort_start_date) AS latest_start_date,
+        MIN(cd.cohort_end_date) AS earliest_end_date,
+        MAX(cd.cohort_end_date) AS latest_end_date,
+        MIN(cd.duration_days) AS min_duration_days,
+        MAX(cd.duration_days) AS max_duration_days,
+        ROUND(AVG(cd.duration_days), 2) AS avg_duration_days,
+        CAST(QUANTILE_CONT(cd.duration_days, 0.5) AS INT) AS median_duration,
+        ROUND(STDDEV(cd.duration_days), 2) AS stddev_duration
+    FROM Cohort_Ids ci
+    LEFT JOIN cohort_Duration cd ON cd.cohort_definition_id = ci.cohort_definition_id
+    GROUP BY ci.cohort_definition_id
+'''
+
+AGE_DISTRIBUTION_QUERY = '''
+    WITH Cohort_Ids AS (
+        SELECT UNNEST(?::INTEGER[]) AS cohort_definition_id
+    ),
+    Age_Cohort AS (
+        SELECT cohort_definition_id, person_id, age 
+        FROM cohort_person
+        WHERE cohort_definition_id IN (SELECT cohort_definition_id FROM Cohort_Ids)
         ),
-    -- Define age bins manually using SELECT statements and UNION ALL
+    -- Assign each cohort member to an age bin and count members per bin with a plain hash aggregate
+    Age_Bin_Counts AS (
+        SELECT
+            cohort_definition_id,
+            CASE
+                WHEN age <= 10 THEN '0-10'
+                WHEN age <= 20 THEN '11-20'
+                WHEN age <= 30 THEN '21-30'
+                WHEN age <= 40 THEN '31-40'
+                WHEN age <= 50 THEN '41-50'
+                WHEN age <= 60 THEN '51-60'
+                WHEN age <= 70 THEN '61-70'
+                WHEN age <= 80 THEN '71-80'
+                WHEN age <= 90 THEN '81-90'
+                ELSE '91+'
+            END AS age_bin,
+            COUNT(*) AS bin_count
+        FROM Age_Cohort
+        WHERE age BETWEEN 0 AND 150  -- Max age is 150 for the last bin
+        GROUP BY ALL
+    ),
+    -- List all age bins so that empty bins are reported with zero counts for each cohort
     Age_Bins AS (
-        SELECT '0-10' AS age_bin, 0 AS min_age, 10 AS max_age
-        UNION ALL SELECT '11-20', 11, 20
-        UNION ALL SELECT '21-30', 21, 30
-        UNION ALL SELECT '31-40', 31, 40
-        UNION ALL SELECT '41-50', 41, 50
-        UNION ALL SELECT '51-60', 51, 60
-        UNION ALL SELECT '61-70', 61, 70
-        UNION ALL SELECT '71-80', 71, 80
-        UNION ALL SELECT '81-90', 81, 90
-        UNION ALL SELECT '91+', 91, 150  -- Max age is 150 for the last bin
+        SELECT * FROM (VALUES ('0-10'), ('11-20'), ('21-30'), ('31-40'), ('41-50'),
+                              ('51-60'), ('61-70'), ('71-80'), ('81-90'), ('91+')) AS b(age_bin)
     ),
-    -- Define age bins and count individuals in each bin
     Age_Distribution AS (    
         SELECT
+            ci.cohort_definition_id,
             b.age_bin,
-            COUNT(ac.person_id) AS bin_count
-        FROM Age_Bins b
-        LEFT JOIN Age_Cohort ac on ac.age BETWEEN b.min_age AND b.max_age
-        GROUP BY age_bin  
+            COALESCE(abc.bin_count, 0) AS bin_count
+        FROM Cohort_Ids ci CROSS JOIN Age_Bins b
+        LEFT JOIN Age_Bin_Counts abc ON abc.cohort_definition_id = ci.cohort_definition_id 
+            AND abc.age_bin = b.age_bin
     )
-    -- Calculate total cohort size and normalize to get probability distribution
+    -- Calculate total cohort size and normalize to get probability distribution per cohort
     SELECT 
+        cohort_definition_id,
         age_bin,
         bin_count,
-        ROUND(bin_count * 1.0 / SUM(bin_count) OVER (), 4) AS probability -- Normalize to get probability
+        -- Normalize to get probability
+        ROUND(bin_count * 1.0 / SUM(bin_count) OVER (PARTITION BY cohort_definition_id), 4) AS probability
     FROM Age_Distribution
-    ORDER BY age_bin                  
+    ORDER BY cohort_definition_id, age_bin                  
 '''
 
 GENDER_DISTRIBUTION_QUERY = '''
-    WITH Gender_Categories AS (
-        SELECT 'male' AS gender, 8507 AS gender_concept_id
-        UNION ALL SELECT 'female', 8532
-        UNION ALL SELECT 'other', NULL  -- NULL to represent any non-male/female cases
+    WITH Cohort_Ids AS (
+        SELECT UNNEST(?::INTEGER[]) AS cohort_definition_id
+    ),
+    Gender_Categories AS (
+        SELECT 'male' AS gender
+        UNION ALL SELECT 'female'
+        UNION ALL SELECT 'other'  -- any non-male/female cases
+    ),
+    -- Count cohort members per raw gender concept id first so that gender labels are only
+    -- assigned to the handful of resulting groups rather than to every cohort member
+    Gender_Concept_Counts AS (
+        SELECT
+            cohort_definition_id,
+            gender_concept_id,
+            COUNT(*) AS concept_count
+        FROM cohort_person
+        WHERE cohort_definition_id IN (SELECT cohort_definition_id FROM Cohort_Ids)
+        GROUP BY cohort_definition_id, gender_concept_id
+    ),
+    Gender_Counts AS (
+        SELECT
+            cohort_definition_id,
+            CASE
+                WHEN gender_concept_id = 8507 THEN 'male'
+                WHEN gender_concept_id = 8532 THEN 'female'
+                ELSE 'other'
+            END AS gender,
+            CAST(SUM(concept_count) AS BIGINT) AS gender_count
+        FROM Gender_Concept_Counts
+        GROUP BY ALL
     ),
     Gender_Distribution AS (
         SELECT
+            ci.cohort_definition_id,
             gc.gender,
-            COUNT(cd.person_id) AS gender_count
-        FROM Gender_Categories gc
-        LEFT JOIN (
-            SELECT
-                CASE
-                    WHEN p.gender_concept_id = 8507 THEN 'male'
-                    WHEN p.gender_concept_id = 8532 THEN 'female'
-                    ELSE 'other'
-                END AS gender,
-                p.person_id
-            FROM cohort c 
-            JOIN person p ON c.subject_id = p.person_id 
-            WHERE c.cohort_definition_id = {}
-        ) cd ON gc.gender = cd.gender
-        GROUP BY gc.gender
+            COALESCE(gcnt.gender_count, 0) AS gender_count  -- Ensure that missing genders are counted as 0
+        FROM Cohort_Ids ci CROSS JOIN Gender_Categories gc
+        LEFT JOIN Gender_Counts gcnt ON gcnt.cohort_definition_id = ci.cohort_definition_id 
+            AND gcnt.gender = gc.gender
     )
-    -- Calculate total cohort size and normalize to get probability distribution
+    -- Calculate total cohort size and normalize to get probability distribution per cohort
     SELECT 
+        cohort_definition_id,
         gender,
-        COALESCE(gender_count, 0) AS gender_count,  -- Ensure that NULL gender counts are treated as 0
-        ROUND(COALESCE(gender_count, 0) * 100.0 / SUM(COALESCE(gender_count, 0)) OVER (), 2) AS probability
+        gender_count,
+        ROUND(gender_count * 100.0 / SUM(gender_count) OVER (PARTITION BY cohort_definition_id), 2) AS probability
     FROM Gender_Distribution
-    ORDER BY gender;
+    ORDER BY cohort_definition_id, gender;
+'''
+
+AGE_REPORT_QUERY = '''
+    WITH Age_Cohort AS (
+        SELECT 
+            age,
+            CASE
+                WHEN age < 0 OR age > 150 THEN NULL  -- ages outside of all bins only count in the stats
+                WHEN age <= 10 THEN '0-10'
+                WHEN age <= 20 THEN '11-20'
+                WHEN age <= 30 THEN '21-30'
+                WHEN age <= 40 THEN '31-40'
+                WHEN age <= 50 THEN '41-50'
+                WHEN age <= 60 THEN '51-60'
+                WHEN age <= 70 THEN '61-70'
+                WHEN age <= 80 THEN '71-80'
+                WHEN age <= 90 THEN '81-90'
+                ELSE '91+'
+            END AS age_bin
+        FROM cohort_person
+        WHERE cohort_definition_id = ?
+    ),
+    -- Calculate age statistics of the whole cohort and the count of each age bin in one pass
+    Age_Groups AS MATERIALIZED (
+        SELECT
+            GROUPING(age_bin) AS is_total,
+            age_bin,
+            COUNT(*) AS total_count,
+            MIN(age) AS min_age,
+            MAX(age) AS max_age,
+            ROUND(AVG(age), 2) AS avg_age,
+            CAST(QUANTILE_CONT(age, 0.5) AS INT) AS median_age,
+            ROUND(STDDEV(age), 2) as stddev_age
+        FROM Age_Cohort
+        GROUP BY GROUPING SETS ((), (age_bin))
+    ),
+    Age_Bins AS (
+        SELECT * FROM (VALUES ('0-10'), ('11-20'), ('21-30'), ('31-40'), ('41-50'),
+                              ('51-60'), ('61-70'), ('71-80'), ('81-90'), ('91+')) AS b(age_bin)
+    )
+    SELECT 
+        1 AS is_total, NULL AS age_bin, NULL AS bin_count, NULL AS probability,
+        total_count, min_age, max_age, avg_age, median_age, stddev_age
+    FROM Age_Groups 
+    WHERE is_total = 1
+    UNION ALL
+    -- Report every age bin, with zero counts for empty bins, and normalize to get probability distribution
+    SELECT
+        0, b.age_bin, COALESCE(ag.total_count, 0), 
+        ROUND(COALESCE(ag.total_count, 0) * 1.0 / SUM(COALESCE(ag.total_count, 0)) OVER (), 4),
+        NULL, NULL, NULL, NULL, NULL, NULL
+    FROM Age_Bins b
+    LEFT JOIN Age_Groups ag ON ag.is_total = 0 AND ag.age_bin = b.age_bin
+    ORDER BY is_total DESC, age_bin
 '''
 
 AGE_STATS_QUERY = '''
     WITH Age_Cohort AS (
-        SELECT p.person_id, EXTRACT(YEAR FROM c.cohort_start_date) - p.year_of_birth AS age 
-        FROM cohort c JOIN person p ON c.subject_id = p.person_id
-        WHERE c.cohort_definition_id = {}
+        SELECT person_id, age 
+        FROM cohort_person
+        WHERE cohort_definition_id = ?
         )
     -- Calculate age distribution statistics    
     SELECT
@@ -83,7 +297,7 @@ AGE_STATS_QUERY = '''
         MIN(age) AS min_age,
         MAX(age) AS max_age,
         ROUND(AVG(age), 2) AS avg_age,
-        CAST(PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY age) AS INT) AS median_age,
+        CAST(QUANTILE_CONT(age, 0.5) AS INT) AS median_age,
         ROUND(STDDEV(age), 2) as stddev_age
     FROM Age_Cohort                
 '''
@@ -97,8 +311,8 @@ GENDER_STATS_QUERY = '''
         END AS gender,     
         COUNT(*) AS gender_count,
         ROUND(COUNT(*) / SUM(COUNT(*)) OVER (), 2) as probability
-    FROM cohort c JOIN person p ON c.subject_id = p.person_id 
-    WHERE c.cohort_definition_id = {}
+    FROM cohort_person p
+    WHERE p.cohort_definition_id = ?
     GROUP BY p.gender_concept_id
 '''
 
@@ -114,8 +328,8 @@ RACE_STATS_QUERY = '''
             END AS race,     
             COUNT(*) AS race_count,
             ROUND(COUNT(*) / SUM(COUNT(*)) OVER (), 2) AS probability
-        FROM cohort c JOIN person p ON c.subject_id = p.person_id
-        WHERE c.cohort_definition_id = {}
+        FROM cohort_person p
+        WHERE p.cohort_definition_id = ?
         GROUP BY p.race_concept_id 
 '''
 
@@ -128,11 +342,17 @@ ETHNICITY_STATS_QUERY = '''
         END AS ethnicity,     
         COUNT(*) AS ethnicity_count,
         ROUND(COUNT(*) / SUM(COUNT(*)) OVER (), 2) AS probability
-    FROM cohort c JOIN person p ON c.subject_id = p.person_id
-    WHERE c.cohort_definition_id = {}
+    FROM cohort_person p
+    WHERE p.cohort_definition_id = ?
     GROUP BY p.ethnicity_concept_id
 '''
 
+# one column of a query computing the stats of several variables in a single round trip, which
+# collects the rows of the variable's stats query as a list of structs
+STATS_BULK_COLUMN = '''
+    (SELECT LIST(s) FROM ({query}) s) AS {variable}
+'''
+
 COHORT_CONCEPT_CONDITION_PREVALENCE_QUERY = '''
     WITH cohort_conditions AS (
         -- Compute the counts for each condition node
@@ -1,5 +1,38 @@
 from biasanalyzer import __version__
+from biasanalyzer.api import BIAS
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_bias_singleton_keeps_state(test_db):
+    bias = BIAS()
+    assert bias is test_db
+    assert bias.config, "Creating BIAS again reset the configuration"
+    assert bias.omop_cdm_db is not None
+
+
+def test_cleanup_without_omop():
+    # use a fresh instance so that the shared test_db fixture is left untouched
+    shared_instance = BIAS._instance
+    BIAS._instance = None
+    try:
+        bias = BIAS()
+        bias.cleanup()
+        assert bias.omop_cdm_db is None and bias.bias_db is None
+        assert BIAS() is not bias, "cleanup did not reset the BIAS singleton"
+    finally:
+        BIAS._instance = shared_instance
+
+
+def test_bias_db_duckdb_settings(test_db):
+    settings = dict(test_db.bias_db.conn.execute(
+        "SELECT name, value FROM duckdb_settings() "
+        "WHERE name IN ('preserve_insertion_order', 'enable_object_cache')").fetchall())
+    assert settings == {'preserve_insertion_order': 'false', 'enable_object_cache': 'true'}
+
+
+def test_omop_execute_query(test_db):
+    rows = test_db.omop_cdm_db.execute_query("SELECT person_id FROM person ORDER BY person_id LIMIT 2")
+    assert rows == [{'person_id': 101}, {'person_id': 102}]
@@ -0,0 +1,396 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+from biasanalyzer.models import Cohort, CohortDefinition
+from biasanalyzer.database import OMOPCDMDatabase
+from biasanalyzer.sql import COHORT_BASIC_STATS_QUERY
+from sqlalchemy import create_engine
+
+
+@pytest.mark.usefixtures
+def test_create_cohort_bulk_insert(test_db):
+    bias = test_db
+    cohort_query = """
+        SELECT person_id, condition_start_date as cohort_start_date,
+        condition_end_date as cohort_end_date
+        FROM condition_occurrence;
+    """
+    cohort = bias.create_cohort(
+        cohort_name="All Conditions Cohort",
+        cohort_desc="Cohort of patients with any condition",
+        query=cohort_query,
+        created_by="test_user"
+    )
+    assert cohort is not None, "Cohort creation failed"
+    cohort_data = cohort.data
+    assert len(cohort_data) == 9, "Bulk insert did not store all cohort rows"
+    assert (cohort_data['cohort_definition_id'] == cohort.cohort_id).all()
+    # ongoing conditions have no end date, which must be preserved as NULL
+    assert cohort_data['cohort_end_date'].isna().sum() == 2
+
+
+@pytest.fixture(scope="module")
+def condition_cohort(test_db):
+    cohort_query = """
+        SELECT person_id, condition_start_date as cohort_start_date,
+        condition_end_date as cohort_end_date
+        FROM condition_occurrence;
+    """
+    return test_db.create_cohort(
+        cohort_name="Condition Stats Cohort",
+        cohort_desc="Cohort of patients with any condition for stats checks",
+        query=cohort_query,
+        created_by="test_user"
+    )
+
+
+def test_cohort_basic_stats(condition_cohort):
+    stats = condition_cohort.get_stats()
+    assert len(stats) == 1
+    assert stats[0]['total_count'] == 9
+    assert stats[0]['min_duration_days'] == 14
+    assert stats[0]['max_duration_days'] == 57
+
+
+def test_cohort_variable_stats(condition_cohort):
+    age_stats = condition_cohort.get_stats('age')
+    assert age_stats[0]['total_count'] == 9
+    assert age_stats[0]['min_age'] == 23
+    assert age_stats[0]['max_age'] == 48
+    gender_stats = {row['gender']: row['gender_count'] for row in condition_cohort.get_stats('gender')}
+    assert gender_stats == {'male': 5, 'female': 4}
+    race_stats = {row['race']: row['race_count'] for row in condition_cohort.get_stats('race')}
+    assert race_stats == {'Black or African American': 6, 'White': 2, 'Asian': 1}
+    ethnicity_stats = {row['ethnicity']: row['ethnicity_count'] for row in condition_cohort.get_stats('ethnicity')}
+    assert ethnicity_stats == {'Hispanic or Latino': 5, 'Not Hispanic or Latino': 4}
+
+
+def test_cohort_distributions(condition_cohort):
+    age_dist = condition_cohort.get_distributions('age')
+    assert [row['age_bin'] for row in age_dist] == ['0-10', '11-20', '21-30', '31-40', '41-50',
+                                                    '51-60', '61-70', '71-80', '81-90', '91+']
+    assert {row['age_bin']: row['bin_count'] for row in age_dist if row['bin_count']} == \
+           {'21-30': 1, '31-40': 5, '41-50': 3}
+    gender_dist = {row['gender']: row['gender_count'] for row in condition_cohort.get_distributions('gender')}
+    assert gender_dist == {'female': 4, 'male': 5, 'other': 0}
+
+
+def test_compare_cohorts(test_db, condition_cohort):
+    results = test_db.compare_cohorts(condition_cohort.cohort_id, condition_cohort.cohort_id)
+    assert results == [{'age_hellinger_distance': 0.0}, {'gender_hellinger_distance': 0.0}]
+
+
+def test_multi_cohort_basic_stats(test_db, condition_cohort):
+    cohort_id = condition_cohort.cohort_id
+    stats = test_db.bias_db.get_multi_cohort_basic_stats([cohort_id, cohort_id, -1])
+    assert set(stats.keys()) == {cohort_id, -1}
+    assert stats[cohort_id] == condition_cohort.get_stats()
+    # a cohort without any rows still reports a zero count
+    assert stats[-1][0]['total_count'] == 0
+
+
+def test_stats_with_non_int_cohort_id(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    cohort_id = condition_cohort.cohort_id
+    assert bias_db.get_cohort_basic_stats(str(cohort_id)) == condition_cohort.get_stats()
+    assert bias_db.get_cohort_basic_stats(np.int64(cohort_id), variable='age') == condition_cohort.get_stats('age')
+    assert bias_db.get_cohort_distributions(str(cohort_id), 'age') == condition_cohort.get_distributions('age')
+    assert list(bias_db.get_multi_cohort_basic_stats([str(cohort_id)])) == [cohort_id]
+
+
+def test_cohort_person_cache_invalidated_on_insert(test_db):
+    cohort_query = """
+        SELECT person_id, condition_start_date as cohort_start_date,
+        condition_end_date as cohort_end_date
+        FROM condition_occurrence WHERE person_id = 106;
+    """
+    cohort = test_db.create_cohort(
+        cohort_name="Fever Cohort",
+        cohort_desc="Cohort of patients with fever",
+        query=cohort_query,
+        created_by="test_user"
+    )
+    assert cohort.get_stats('age')[0]['total_count'] == 1
+    assert test_db.bias_db.get_cohort_basic_stats(cohort.cohort_id)[0]['total_count'] == 1
+    assert sum(d['bin_count'] for d in test_db.bias_db.get_cohort_distributions(cohort.cohort_id, 'age')) == 1
+    test_db.bias_db.create_cohorts_bulk([(101, cohort.cohort_id, date(2023, 1, 1), date(2023, 1, 31))])
+    age_stats = test_db.bias_db.get_cohort_basic_stats(cohort.cohort_id, variable='age')
+    assert age_stats[0]['total_count'] == 2
+    assert age_stats[0]['max_age'] == 43
+    assert test_db.bias_db.get_cohort_basic_stats(cohort.cohort_id)[0]['total_count'] == 2
+    assert sum(d['bin_count'] for d in test_db.bias_db.get_cohort_distributions(cohort.cohort_id, 'age')) == 2
+    assert cohort.get_stats()[0]['total_count'] == 2
+    assert cohort.get_stats('age')[0]['max_age'] == 43
+    assert sum(d['bin_count'] for d in cohort.get_distributions('age')) == 2
+
+
+def test_results_cache_bounded(test_db, condition_cohort, monkeypatch):
+    bias_db = test_db.bias_db
+    monkeypatch.setattr(type(bias_db), 'results_cache_size', 2)
+    monkeypatch.setattr(bias_db, '_results_cache', OrderedDict())
+    cohort_id = condition_cohort.cohort_id
+    for variable in ('age', 'gender', 'race'):
+        bias_db.get_cohort_basic_stats(cohort_id, variable=variable)
+    assert len(bias_db._results_cache) == 2
+    assert list(bias_db._results_cache)[-2:] == [(cohort_id, 'stats_gender'), (cohort_id, 'stats_race')]
+    # a dropped result is recomputed
+    assert bias_db.get_cohort_basic_stats(cohort_id, variable='age')[0]['total_count'] == 9
+
+
+def test_empty_cohort(test_db):
+    bias_db = test_db.bias_db
+    cohort = test_db.create_cohort(
+        cohort_name="Empty Cohort",
+        cohort_desc="Cohort matching no patients",
+        query="SELECT person_id, condition_start_date as cohort_start_date, "
+              "condition_end_date as cohort_end_date FROM condition_occurrence WHERE person_id = 0",
+        created_by="test_user"
+    )
+    assert bias_db._cohort_sizes[cohort.cohort_id] == 0
+    assert cohort.get_stats('gender') == []
+    assert cohort.get_stats()[0]['total_count'] == 0
+    bias_db.create_cohorts_bulk([(101, cohort.cohort_id, date(2023, 1, 1), date(2023, 1, 31))])
+    assert bias_db._cohort_sizes[cohort.cohort_id] == 1
+    assert bias_db.get_cohort_basic_stats(cohort.cohort_id, variable='age')[0]['total_count'] == 1
+
+
+def test_cluster_cohort_table(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    cohort_before = condition_cohort.data
+    bias_db._cluster_cohort_table()
+    cohort_ids = [row[0] for row in bias_db.conn.execute('SELECT cohort_definition_id FROM cohort').fetchall()]
+    assert cohort_ids == sorted(cohort_ids)
+    cohort_after = bias_db.get_cohort(condition_cohort.cohort_id)
+    assert len(cohort_after) == len(cohort_before)
+    assert bias_db.get_cohort_basic_stats(condition_cohort.cohort_id) == condition_cohort.get_stats()
+
+
+def test_cluster_trigger_relative_to_table_size(test_db, monkeypatch):
+    bias_db = test_db.bias_db
+    cohort_def_id = bias_db.create_cohort_definition(CohortDefinition(
+        name="Single Row Cohort", description="Cohort inserted one row at a time", created_date=date.today(),
+        creation_info="manual", created_by="test_user"))
+    cluster_calls = []
+    monkeypatch.setattr(bias_db, '_cluster_cohort_table', lambda: cluster_calls.append(1))
+    monkeypatch.setattr(type(bias_db), 'cohort_cluster_threshold', 1)
+    monkeypatch.setattr(type(bias_db), 'cohort_cluster_fraction', 0.5)
+    monkeypatch.setattr(bias_db, '_unclustered_cohort_rows', 0)
+    monkeypatch.setattr(bias_db, '_cluster_rows_needed', 1)
+    total_rows = bias_db.conn.execute('SELECT COUNT(*) FROM cohort').fetchone()[0]
+    cohort = Cohort(subject_id=101, cohort_definition_id=cohort_def_id,
+                    cohort_start_date=date(2023, 1, 1), cohort_end_date=date(2023, 1, 31))
+    bias_db.create_cohort(cohort)
+    # one unclustered row is far below half of the table, so the rewrite waits for more inserts
+    assert cluster_calls == []
+    assert bias_db._cluster_rows_needed == int((total_rows + 1) * 0.5)
+    inserted_rows = 1
+    while not cluster_calls and inserted_rows <= 2 * total_rows:
+        bias_db.create_cohort(cohort)
+        inserted_rows += 1
+    # the rewrite happens once the single-row inserts make up about half of the table
+    assert cluster_calls == [1]
+    assert inserted_rows >= total_rows - 1
+
+
+def test_cohort_stats_reflect_inserted_rows(test_db):
+    cohort = test_db.create_cohort(
+        cohort_name="Growing Cohort",
+        cohort_desc="Cohort receiving rows after its stats were read",
+        query="SELECT person_id, condition_start_date as cohort_start_date, "
+              "condition_end_date as cohort_end_date FROM condition_occurrence WHERE person_id = 106",
+        created_by="test_user"
+    )
+    stats = cohort.get_stats()
+    assert stats[0]['total_count'] == 1
+    assert cohort.get_stats() == stats and cohort.get_stats() is not stats
+    assert sum(d['bin_count'] for d in cohort.get_distributions('age')) == 1
+    test_db.bias_db.create_cohorts_bulk([(101, cohort.cohort_id, date(2023, 1, 1), date(2023, 1, 31))])
+    assert cohort.get_stats()[0]['total_count'] == 2
+    assert cohort.get_stats('age')[0]['total_count'] == 2
+    assert sum(d['bin_count'] for d in cohort.get_distributions('age')) == 2
+    assert cohort.get_stats_bulk(['age'])['age'][0]['max_age'] == 43
+
+
+def test_cohort_stats_bulk(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    cohort_id = condition_cohort.cohort_id
+    bias_db._invalidate_cohort_caches([cohort_id])
+    bulk_stats = bias_db.get_cohort_stats_bulk(cohort_id)
+    bias_db._invalidate_cohort_caches([cohort_id])
+    for variable in ('age', 'gender', 'race', 'ethnicity'):
+        stats = bias_db.get_cohort_basic_stats(cohort_id, variable=variable)
+        assert sorted(bulk_stats[variable], key=str) == sorted(stats, key=str)
+    assert bias_db.get_cohort_stats_bulk(cohort_id, variables=['foo']) is None
+
+
+def test_cohort_relations(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    cohort_id = condition_cohort.cohort_id
+    cohort_rel = bias_db.get_cohort_rel(cohort_id)
+    assert len(cohort_rel.df()) == len(condition_cohort.data)
+    assert cohort_rel.filter('subject_id = 106').aggregate('count(*)').fetchone()[0] == \
+        (condition_cohort.data['subject_id'] == 106).sum()
+    stats_rel = bias_db.get_cohort_basic_stats_rel(cohort_id)
+    assert bias_db._fetch_dicts(stats_rel, stats_rel.columns) == condition_cohort.get_stats()
+    age_rel = bias_db.get_cohort_basic_stats_rel(cohort_id, variable='age')
+    assert bias_db._fetch_dicts(age_rel, age_rel.columns) == condition_cohort.get_stats('age')
+    dist_rel = bias_db.get_cohort_distributions_rel(cohort_id, 'age')
+    assert bias_db._fetch_dicts(dist_rel, dist_rel.columns) == condition_cohort.get_distributions('age')
+    assert bias_db.get_cohort_distributions_rel(cohort_id, 'foo') is None
+
+
+
+def test_relations_reflect_inserted_rows(test_db):
+    bias_db = test_db.bias_db
+    cohort_def_id = bias_db.create_cohort_definition(CohortDefinition(
+        name="Relation Insert Cohort", description="Cohort receiving rows after its relations were built",
+        created_date=date.today(), creation_info="manual", created_by="test_user"))
+    bias_db.create_cohorts_bulk([(106, cohort_def_id, date(2023, 1, 1), date(2023, 1, 31))])
+    age_rel = bias_db.get_cohort_basic_stats_rel(cohort_def_id, variable='age')
+    dist_rel = bias_db.get_cohort_distributions_rel(cohort_def_id, 'age')
+    assert age_rel.fetchall()[0][0] == 1
+    bias_db.create_cohorts_bulk([(101, cohort_def_id, date(2023, 1, 1), date(2023, 1, 31))])
+    age_stats = bias_db._fetch_dicts(age_rel, age_rel.columns)
+    assert age_stats == bias_db.get_cohort_basic_stats(cohort_def_id, variable='age')
+    assert age_stats[0]['total_count'] == 2 and age_stats[0]['max_age'] == 43
+    dist = bias_db._fetch_dicts(dist_rel, dist_rel.columns)
+    assert dist == bias_db.get_cohort_distributions(cohort_def_id, 'age')
+    assert sum(d['bin_count'] for d in dist) == 2
+
+
+def test_multi_cohort_relation(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    cohort_ids = [condition_cohort.cohort_id, bias_db.create_cohort_definition(CohortDefinition(
+        name="Relation Cohort", description="Empty cohort for relations", created_date=date.today(),
+        creation_info="manual", created_by="test_user"))]
+    stats_rel = bias_db._cohort_relation(COHORT_BASIC_STATS_QUERY, cohort_ids)
+    rel_stats = {}
+    for row in bias_db._fetch_dicts(stats_rel, stats_rel.columns):
+        rel_stats[row.pop('cohort_definition_id')] = [row]
+    assert rel_stats == bias_db.get_multi_cohort_basic_stats(cohort_ids)
+    with pytest.raises(ValueError):
+        bias_db._cohort_relation('SELECT ? AS a, ? AS b', cohort_ids)
+
+
+def test_cohort_stats_error_logged(test_db, condition_cohort, caplog):
+    with caplog.at_level(logging.ERROR, logger='biasanalyzer.database'):
+        assert test_db.bias_db.get_cohort_basic_stats(condition_cohort.cohort_id, variable='foo') is None
+    assert "Statistics for variable 'foo' is not available" in caplog.text
+    # invalid input is reported without a stack trace
+    assert caplog.records[-1].levelno == logging.ERROR and caplog.records[-1].exc_info is None
+
+
+def test_cached_stats_not_shared(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    cohort_id = condition_cohort.cohort_id
+    bias_db.get_cohort_basic_stats(cohort_id, variable='age')[0]['total_count'] = -1
+    bias_db.get_cohort_basic_stats(cohort_id)[0]['total_count'] = -1
+    bias_db.get_cohort_distributions(cohort_id, 'age')[0]['probability'] = -1
+    bias_db.get_cohort_stats_bulk(cohort_id)['age'][0]['total_count'] = -1
+    assert bias_db.get_cohort_basic_stats(cohort_id, variable='age')[0]['total_count'] == 9
+    assert bias_db.get_cohort_basic_stats(cohort_id)[0]['total_count'] == 9
+    assert bias_db.get_cohort_distributions(cohort_id, 'age')[0]['probability'] >= 0
+    assert bias_db.get_cohort_stats_bulk(cohort_id)['age'][0]['total_count'] == 9
+
+
+def test_execute_query_in_batches(test_db):
+    batches = list(test_db.omop_cdm_db.execute_query_in_batches(
+        "SELECT person_id FROM range(5000) r(person_id)", batch_size=2048))
+    assert [len(batch) for batch in batches] == [2048, 2048, 904]
+    assert batches[0]['person_id'].iloc[0] == 0
+
+
+def test_get_cohort_in_batches(test_db, condition_cohort):
+    bias_db = test_db.bias_db
+    batches = list(bias_db.get_cohort_in_batches(condition_cohort.cohort_id, batch_size=10))
+    assert sum(len(batch) for batch in batches) == len(condition_cohort.data)
+    # other queries can run while a batch stream is open
+    stream = bias_db.get_cohort_in_batches(condition_cohort.cohort_id)
+    first_batch = next(stream)
+    assert bias_db.get_cohort_definition(condition_cohort.cohort_id)['id'] == condition_cohort.cohort_id
+    assert len(first_batch) + sum(len(batch) for batch in stream) == len(condition_cohort.data)
+
+
+def test_execute_query_in_batches_sqlalchemy():
+    # exercise the SQLAlchemy streaming branch used for postgreSQL with an in-memory SQLite engine,
+    # bypassing the OMOPCDMDatabase singleton so that the shared test database is left untouched
+    omop_db = object.__new__(OMOPCDMDatabase)
+    omop_db._database_type = 'postgresql'
+    omop_db.engine = create_engine('sqlite://')
+    query = '''
+        WITH RECURSIVE r(person_id) AS (SELECT 1 UNION ALL SELECT person_id + 1 FROM r WHERE person_id < :n)
+        SELECT person_id FROM r
+    '''
+    batches = list(omop_db.execute_query_in_batches(query, params={'n': 5}, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert list(batches[0].columns) == ['person_id']
+    assert pd.concat(batches)['person_id'].tolist() == [1, 2, 3, 4, 5]
+
+
+def test_cohort_age_report(condition_cohort):
+    report = condition_cohort.age_report()
+    assert report['stats'] == condition_cohort.get_stats('age')
+    assert report['distribution'] == condition_cohort.get_distributions('age')
+
+
+def test_create_cohort_from_parquet(test_db, tmp_path):
+    parquet_path = str(tmp_path / 'cohort.parquet')
+    test_db.omop_cdm_db.engine.execute(f"""
+        COPY (SELECT person_id, condition_start_date AS cohort_start_date, condition_end_date AS cohort_end_date
+              FROM condition_occurrence WHERE condition_concept_id = 4) TO '{parquet_path}' (FORMAT PARQUET)
+    """)
+    cohort = test_db.create_cohort_from_parquet(
+        cohort_name="Retinopathy Cohort",
+        cohort_desc="Cohort of patients with diabetic retinopathy",
+        parquet_path=parquet_path,
+        created_by="test_user"
+    )
+    assert cohort is not None, "Cohort creation from parquet failed"
+    assert sorted(cohort.data['subject_id'].tolist()) == [103, 104, 105]
+
+
+def test_cohort_metadata(test_db, condition_cohort):
+    metadata = condition_cohort.metadata
+    assert metadata['id'] == condition_cohort.cohort_id
+    assert metadata['name'] == "Condition Stats Cohort"
+    assert metadata['created_by'] == "test_user"
+    assert test_db.bias_db.get_cohort_definition(-1) == {}
+
+
+def test_create_cohorts(test_db):
+    bias_db = test_db.bias_db
+    cohort_def_id = bias_db.create_cohort_definition(CohortDefinition(
+        name="Manual Cohort", description="Cohort inserted from Cohort records", created_date=date.today(),
+        creation_info="manual", created_by="test_user"))
+    bias_db.create_cohorts([
+        Cohort(subject_id=101, cohort_definition_id=cohort_def_id, cohort_start_date=date(2023, 1, 1),
+               cohort_end_date=date(2023, 1, 31)),
+        Cohort(subject_id=102, cohort_definition_id=cohort_def_id, cohort_start_date=date(2023, 2, 1),
+               cohort_end_date=None),
+    ])
+    assert sorted(bias_db.get_cohort(cohort_def_id)['subject_id'].tolist()) == [101, 102]
+
+
+def test_get_cohort_ordered_by_subject(test_db):
+    bias_db = test_db.bias_db
+    cohort_def_id = bias_db.create_cohort_definition(CohortDefinition(
+        name="Unordered Cohort", description="Cohort inserted out of subject order", created_date=date.today(),
+        creation_info="manual", created_by="test_user"))
+    bias_db.create_cohorts([
+        Cohort(subject_id=subject_id, cohort_definition_id=cohort_def_id, cohort_start_date=date(2023, 1, 1),
+               cohort_end_date=None) for subject_id in (205, 201, 204, 202, 203)])
+    assert bias_db.get_cohort(cohort_def_id)['subject_id'].tolist() == [201, 202, 203, 204, 205]
+    batches = list(bias_db.get_cohort_in_batches(cohort_def_id, batch_size=2))
+    assert pd.concat(batches)['subject_id'].tolist() == [201, 202, 203, 204, 205]
+
+
+def test_concept_stats_from_threads(condition_cohort):
+    expected = condition_cohort.get_concept_stats()
+    assert expected['condition_occurrence'], "No concept stats returned"
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: condition_cohort.get_concept_stats(), range(8)))
+    assert all(result == expected for result in results)